@@ -15,6 +15,8 @@
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import urwid, time, socket, json, functools, argparse
+import os, select, errno, threading
+from rydetrace import tracer, runProfiled
 
 # Urwid widget that requires ctrl to be held to havigate ListBox
 class ListBoxRekey(urwid.ListBox):
@@ -76,6 +78,7 @@ class EventFrame(urwid.WidgetWrap):
         urwid.WidgetWrap.__init__(self, self.cols)
 
     # append text to the event log box includeing a timestamp
+    @tracer.traced("appendTxt")
     def appendTxt(self, txt):
         txtBox = urwid.AttrMap(urwid.Text(time.strftime('%H:%M:%S')+": "+txt), None, focus_map='reversed')
         self.walker.append(txtBox)
@@ -101,6 +104,185 @@ class EventFrame(urwid.WidgetWrap):
         else:
             return self.cols.keypress(size, key)
 
+# manages the network connection to the receiver
+# caches resolved addresses, races IPv4 and IPv6 when connecting and keeps a checked spare connection ready for the next event
+class ReceiverConnection(object):
+    ADDRESS_TTL = 60
+    RACE_DELAY = 0.25
+    CONNECT_TIMEOUT = 5
+    RESPONSE_TIMEOUT = 5
+
+    def __init__(self, host, port, statusCallback = None):
+        self.host = host
+        self.port = port
+        self.statusCallback = statusCallback
+        self.lock = threading.Lock()
+        self.addresses = None
+        self.resolvedAt = None
+        self.spare = None
+        self.warming = False
+        self.reachable = None
+
+    # returns resolved addresses, refreshing them once the cached ones expire
+    # stale addresses are kept if a refresh fails
+    def resolve(self):
+        with self.lock:
+            addresses = self.addresses
+            if addresses is not None and time.monotonic()-self.resolvedAt < self.ADDRESS_TTL:
+                return addresses
+        try:
+            with tracer.span("resolve", host=self.host):
+                found = socket.getaddrinfo(self.host, self.port, type=socket.SOCK_STREAM)
+        except socket.gaierror:
+            if addresses is None:
+                raise
+            return addresses
+        # interleave address families so both get tried early, starting with the preferred family
+        byFamily = {}
+        for address in found:
+            byFamily.setdefault(address[0], []).append(address)
+        addresses = []
+        familyLists = list(byFamily.values())
+        while any(familyLists):
+            for familyList in familyLists:
+                if familyList:
+                    addresses.append(familyList.pop(0))
+        with self.lock:
+            self.addresses = addresses
+            self.resolvedAt = time.monotonic()
+        return addresses
+
+    # start connecting to each address in turn, each one gets a head start before the next is started
+    # the first to complete is returned and the rest are closed
+    def _raceConnect(self, addresses):
+        remaining = list(addresses)
+        pending = {}
+        winner = None
+        lastError = None
+        deadline = time.monotonic()+self.CONNECT_TIMEOUT
+        try:
+            while (remaining or pending) and winner is None:
+                if remaining:
+                    family, sockType, proto, canonName, sockAddr = remaining.pop(0)
+                    try:
+                        newSocket = socket.socket(family, sockType, proto)
+                    except OSError as exc:
+                        lastError = exc
+                        continue
+                    newSocket.setblocking(False)
+                    err = newSocket.connect_ex(sockAddr)
+                    if err in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                        pending[newSocket] = sockAddr
+                    else:
+                        lastError = OSError(err, os.strerror(err))
+                        newSocket.close()
+                        continue
+                waitTime = deadline-time.monotonic()
+                if waitTime <= 0:
+                    break
+                if remaining:
+                    waitTime = min(waitTime, self.RACE_DELAY)
+                writable = select.select([], list(pending), [], waitTime)[1]
+                for candidate in writable:
+                    err = candidate.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if err == 0:
+                        winner = candidate
+                        break
+                    lastError = OSError(err, os.strerror(err))
+                    del pending[candidate]
+                    candidate.close()
+        finally:
+            for candidate in pending:
+                if candidate is not winner:
+                    candidate.close()
+        if winner is None:
+            if lastError is None:
+                lastError = socket.timeout("timed out connecting to "+self.host)
+            raise lastError
+        winner.setblocking(True)
+        winner.settimeout(self.RESPONSE_TIMEOUT)
+        return winner
+
+    def _connect(self):
+        try:
+            with tracer.span("connect", host=self.host, port=self.port):
+                newSocket = self._raceConnect(self.resolve())
+        except Exception as exc:
+            self._setReachable(False, str(exc))
+            raise
+        self._setReachable(True, str(newSocket.getpeername()[0]))
+        return newSocket
+
+    # report changes in receiver reachability to the status callback
+    def _setReachable(self, reachable, detail):
+        with self.lock:
+            changed = reachable != self.reachable
+            self.reachable = reachable
+        if changed and self.statusCallback is not None:
+            if reachable:
+                self.statusCallback("Receiver reachable at "+detail)
+            else:
+                self.statusCallback("Receiver unreachable: "+detail)
+
+    # an idle connection should have nothing to read, if it does the receiver has closed it
+    @staticmethod
+    def _isAlive(checkSocket):
+        try:
+            return not select.select([checkSocket], [], [], 0)[0]
+        except (OSError, ValueError):
+            return False
+
+    # make sure a live spare connection is ready, replacing a dead one
+    def prewarm(self):
+        with self.lock:
+            if self.warming:
+                return
+            spare = self.spare
+            self.spare = None
+            self.warming = True
+        try:
+            if spare is not None and not self._isAlive(spare):
+                spare.close()
+                spare = None
+            if spare is None:
+                try:
+                    spare = self._connect()
+                except Exception:
+                    spare = None
+            with self.lock:
+                if self.spare is None:
+                    self.spare = spare
+                    spare = None
+            if spare is not None:
+                spare.close()
+        finally:
+            with self.lock:
+                self.warming = False
+
+    # prewarm in a background thread so the UI is never held up
+    def prewarmInBackground(self):
+        threading.Thread(target=self.prewarm, daemon=True).start()
+
+    # returns a connected socket, using the spare if it is still alive, and starts warming a replacement
+    def take(self):
+        with self.lock:
+            spare = self.spare
+            self.spare = None
+        if spare is not None and not self._isAlive(spare):
+            spare.close()
+            spare = None
+        if spare is None:
+            spare = self._connect()
+        self.prewarmInBackground()
+        return spare
+
+    def close(self):
+        with self.lock:
+            spare = self.spare
+            self.spare = None
+        if spare is not None:
+            spare.close()
+
 class RydeConsoleHandset(object):
     def __init__(self, host = 'localhost', port = 8765, startWithInstructions = False):
         # map of urwid events to ryde events
@@ -141,11 +323,11 @@ class RydeConsoleHandset(object):
         instructions.append("\nNumber keys are also supported\n")
         
         # Visible UI components
-        eventBox = EventFrame(keymap, self.publishEventCallback, instructions, startWithInstructions)
+        self.eventBox = EventFrame(keymap, self.publishEventCallback, instructions, startWithInstructions)
         titlebox = urwid.AttrMap(urwid.Text('Ryde Network Console Handset', align='center'), 'title')
         footerbox = urwid.AttrMap(urwid.Text(["Press ",("highlight", "esc")," to exit, ",("highlight", "tab")," to show help or hold ",("highlight", "ctrl"), " to navigate the log."]), 'footer')
         # main layout frames
-        main = urwid.Frame(eventBox, titlebox, footerbox)
+        main = urwid.Frame(self.eventBox, titlebox, footerbox)
         background = urwid.AttrMap(urwid.SolidFill(), 'bg')
         top = urwid.Overlay(main, background,
             align='center', width=('relative', 80),
@@ -164,47 +346,69 @@ class RydeConsoleHandset(object):
 
         # main urwid loop
         self.loop = urwid.MainLoop(top, palette=pallette, unhandled_input=self.unhandledEvent)
+        self.loop.draw_screen = tracer.traced("draw_screen")(self.loop.draw_screen)
 
         self.host = host
         self.port = port
+        # status messages from background connection threads are passed to the main loop through a pipe
+        self.statusPipe = self.loop.watch_pipe(self.handleStatus)
+        self.connection = ReceiverConnection(host, port, self.postStatus)
+
+    def postStatus(self, txt):
+        os.write(self.statusPipe, bytes(txt.replace("\n", " ")+"\n", encoding="utf-8"))
+
+    def handleStatus(self, data):
+        for txt in str(data, encoding="utf-8").splitlines():
+            self.eventBox.appendTxt(txt)
+        return True
+
+    # keep a spare connection checked and ready, this also notices the receiver going away or coming back
+    def healthCheck(self, loop = None, userData = None):
+        self.connection.prewarmInBackground()
+        self.loop.set_alarm_in(self.connection.ADDRESS_TTL/4, self.healthCheck)
 
     def unhandledEvent(self, key):
         if key == 'esc':
             raise urwid.ExitMainLoop()
 
+    @tracer.traced("publishEvent")
     def publishEventCallback(self, appendTxt, event):
         appendTxt(event)
         # form network request
         sendEventReq = {'request':'sendEvent', 'event':event}
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as eventSocket:
-            eventRespRaw = None
+        eventRespRaw = None
+        try:
+            with self.connection.take() as eventSocket:
+                with tracer.span("sendall"):
+                    eventSocket.sendall(bytes(json.dumps(sendEventReq), encoding="utf-8"))
+                with tracer.span("recv"):
+                    eventRespRaw = eventSocket.recv(1024)
+        except Exception:
+            appendTxt("Network error while sending event")
+        if eventRespRaw is not None: # No network errors
             try:
-                eventSocket.connect((self.host, self.port))
-                eventSocket.sendall(bytes(json.dumps(sendEventReq), encoding="utf-8"))
-                eventRespRaw = eventSocket.recv(1024)
-                eventSocket.close()
-            except Exception:
-                appendTxt("Network error while sending event")
-            if eventRespRaw is not None: # No network errors
-                try:
-                    eventResp = json.loads(eventRespRaw)
-                except json.JSONDecodeError:
-                    eventResp = None
-                    appendTxt("Unexpected server response, invalid json")
-                if isinstance(eventResp, dict) and 'success' in eventResp and isinstance(eventResp['success'], bool):
-                    if not eventResp['success']:
-                        if 'error' in eventResp and isinstance(eventResp['error'], str):
-                            appendTxt("Server returned error: "+eventResp['error'])
-                        else:
-                            appendTxt("Server returned general error")
-                else:
-                    appendTxt("Unexpected server response, invalid format")
+                eventResp = json.loads(eventRespRaw)
+            except json.JSONDecodeError:
+                eventResp = None
+                appendTxt("Unexpected server response, invalid json")
+            if isinstance(eventResp, dict) and 'success' in eventResp and isinstance(eventResp['success'], bool):
+                if not eventResp['success']:
+                    if 'error' in eventResp and isinstance(eventResp['error'], str):
+                        appendTxt("Server returned error: "+eventResp['error'])
+                    else:
+                        appendTxt("Server returned general error")
             else:
-                appendTxt("Unexpected server response")
+                appendTxt("Unexpected server response, invalid format")
+        else:
+            appendTxt("Unexpected server response")
         return True
 
     def run(self):
-        self.loop.run()
+        self.healthCheck()
+        try:
+            self.loop.run()
+        finally:
+            self.connection.close()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Network console handset for Ryde receiver")
@@ -212,6 +416,9 @@ if __name__ == "__main__":
     parser.add_argument("-H", "--host", help="network host name or address of Ryde receiver", default="localhost")
     parser.add_argument("-P", "--port", help="network port of Ryde receiver", default=8765)
     parser.add_argument("-i", "--instructions", action="store_true", help="start with instructions showing")
+    parser.add_argument("-p", "--profile", nargs="?", const="consolehandset-profile", default=None, metavar="PREFIX", help="record a profile and trace to PREFIX.prof and PREFIX.json")
     args = parser.parse_args()
-    consoleHandset = RydeConsoleHandset(host = args.host, port = args.port, startWithInstructions = args.instructions)
-    consoleHandset.run()
+    def main():
+        consoleHandset = RydeConsoleHandset(host = args.host, port = args.port, startWithInstructions = args.instructions)
+        consoleHandset.run()
+    runProfiled(args.profile, main)
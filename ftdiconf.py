@@ -15,11 +15,13 @@
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import enum, urwid, argparse
-import configparser, io
+import configparser, io, array, struct, time
+import usb.core
 import pyftdi.ftdi
 import pyftdi.usbtools
 import pyftdi.eeprom
 import pyftdi
+from rydetrace import tracer, runProfiled
 
 # enum of usb module hex dumps to base configs on
 # this is a temporary solution until pyftdi supports more properties
@@ -267,59 +269,506 @@ class ProgressPopUp(urwid.Overlay):
     def draw(self):
         self.loop.draw_screen()
 
+# counts the usb control transfers made on a pyusb device while in use as a context manager
+class UsbTransferCounter(object):
+    def __init__(self, device):
+        self.device = device
+        self.count = 0
+
+    def __enter__(self):
+        realTransfer = self.device.ctrl_transfer
+        def countedTransfer(*args, **kwargs):
+            self.count += 1
+            return realTransfer(*args, **kwargs)
+        self.device.ctrl_transfer = countedTransfer
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        del self.device.ctrl_transfer
+        return False
+
+# raw word level access to the FT2232H EEPROM directly over usb control transfers
+# this skips the port setup and tear down done by pyftdi and only transfers the words that are needed
+class RawEeprom(object):
+    SIZE = 0x100
+    TIMEOUT = 5000
+
+    def __init__(self, device):
+        self.device = device
+        self.image = bytearray(self.SIZE)
+        self.length = 0
+        self._wordBuf = array.array('B', bytes(2))
+
+    # read a range of words into the image, addresses are in bytes
+    def _readWords(self, start, end):
+        try:
+            for addr in range(start, end, 2):
+                if self.device.ctrl_transfer(pyftdi.ftdi.Ftdi.REQ_IN, pyftdi.ftdi.Ftdi.SIO_REQ_READ_EEPROM, 0, addr >> 1, self._wordBuf, self.TIMEOUT) != 2:
+                    raise pyftdi.eeprom.FtdiEepromError("EEPROM read error @ {0}".format(addr))
+                self.image[addr:addr+2] = self._wordBuf
+        except usb.core.USBError as exc:
+            raise pyftdi.ftdi.FtdiError("UsbError: {0}".format(exc)) from exc
+
+    # checksum of the image as calculated by the FTDI chip, covers everything up to the checksum word at the end
+    @staticmethod
+    def _checksum(view):
+        checksum = 0xAAAA
+        for (word,) in struct.iter_unpack('<H', view):
+            checksum ^= word
+            checksum = ((checksum << 1) | (checksum >> 15)) & 0xFFFF
+        return checksum
+
+    def _checksumValid(self, size):
+        view = memoryview(self.image)
+        return self._checksum(view[:size-2]) == struct.unpack_from('<H', self.image, size-2)[0]
+
+    # read the whole EEPROM, a 93C46 that self identifies with a valid checksum only needs the lower half reading
+    def read(self):
+        half = self.SIZE//2
+        self._readWords(0, half)
+        if self.image[0x18] == 0x46 and self._checksumValid(half):
+            self.length = half
+            return self.image
+        self._readWords(half, self.SIZE)
+        self.length = self.SIZE
+        return self.image
+
+    # the image as a full read would have returned it, a 93C46 repeats in the upper half
+    def fullImage(self):
+        if self.length < self.SIZE:
+            return bytes(memoryview(self.image)[:self.length])*(self.SIZE//self.length)
+        return bytes(self.image)
+
+    # usable size of the image, smaller EEPROMs show up mirrored in a full read
+    @property
+    def size(self):
+        view = memoryview(self.image)
+        if self.length < self.SIZE:
+            return self.length
+        if all(byte == 0xFF for byte in view):
+            return self.SIZE
+        if view[0:0x80] == view[0x80:0x100]:
+            return 0x80
+        if view[0:0x40] == view[0x40:0x80]:
+            return 0x40
+        return self.SIZE
+
+    def _decodeString(self, offset):
+        strOffset, strSize = self.image[offset], self.image[offset+1]
+        if strSize:
+            strOffset = (strOffset & (self.length-1)) + 2
+            return str(memoryview(self.image)[strOffset:strOffset+strSize-2], 'utf16', 'ignore')
+        return ''
+
+    # decodes the same config name/value pairs as pyftdi does for an FT2232H straight from the image
+    # returns an empty set if the checksum is bad as pyftdi does not decode those images
+    def signature(self, deviceVersion=0x0700):
+        if not self._checksumValid(self.size):
+            return frozenset()
+        image = self.image
+        vendorId, productId, deviceType, powerSupply, powerMax, conf = struct.unpack_from('<3H3B', image, 0x02)
+        signature = [
+            ('chip', image[0x18]),
+            ('vendor_id', vendorId),
+            ('product_id', productId),
+            ('type', deviceType),
+            ('self_powered', bool(powerSupply & (1 << 6))),
+            ('remote_wakeup', bool(powerSupply & (1 << 5))),
+            ('power_max', powerMax << 1),
+            ('has_serial', bool(conf & (1 << 3))),
+            ('suspend_pull_down', bool(conf & (1 << 2))),
+            ('out_isochronous', bool(conf & (1 << 1))),
+            ('in_isochronous', bool(conf & (1 << 0))),
+            ('product', self._decodeString(0x10)),
+        ]
+        if (deviceType or deviceVersion) == 0x0700:
+            cfg0, cfg1 = image[0x00], image[0x01]
+            drive = pyftdi.eeprom.FtdiEeprom.DRIVE
+            signature.append(('channel_a_driver', 'VCP' if (cfg0 & (1 << 3)) else 'D2XX'))
+            signature.append(('channel_b_driver', 'VCP' if (cfg1 & (1 << 3)) else 'D2XX'))
+            for group in range(4):
+                val = image[0x0c + group//2] >> (4*(group & 1))
+                signature.append(('group_{0}_drive'.format(group), 4 * (1+(val & (drive.LOW.value | drive.HIGH.value)))))
+                signature.append(('group_{0}_schmitt'.format(group), bool(val & drive.SCHMITT.value)))
+                signature.append(('group_{0}_slow_slew'.format(group), bool(val & drive.SLOW_SLEW.value)))
+            signature.append(('channel_a_type', pyftdi.eeprom.FtdiEeprom.CHANNEL(cfg0 & 0x7).name or 'UART'))
+            signature.append(('channel_b_type', pyftdi.eeprom.FtdiEeprom.CHANNEL(cfg1 & 0x7).name or 'UART'))
+            signature.append(('suspend_dbus7', pyftdi.eeprom.FtdiEeprom.CFG1(cfg1 & pyftdi.eeprom.FtdiEeprom.CFG1.SUSPEND_DBUS7)))
+        return frozenset(signature)
+
+    # write only the words that differ from the current contents then read those back to verify
+    # words past the end of the current contents are always written
+    def write(self, oldImage, newImage, dryRun=True):
+        changed = []
+        for addr in range(0, len(newImage), 2):
+            if addr+2 > len(oldImage) or oldImage[addr:addr+2] != newImage[addr:addr+2]:
+                changed.append(addr)
+        if dryRun:
+            return changed
+        try:
+            for addr in changed:
+                word = struct.unpack_from('<H', newImage, addr)[0]
+                if self.device.ctrl_transfer(pyftdi.ftdi.Ftdi.REQ_OUT, pyftdi.ftdi.Ftdi.SIO_REQ_WRITE_EEPROM, word, addr >> 1, b'', self.TIMEOUT):
+                    raise pyftdi.eeprom.FtdiEepromError("EEPROM Write Error @ {0}".format(addr))
+        except usb.core.USBError as exc:
+            raise pyftdi.ftdi.FtdiError("UsbError: {0}".format(exc)) from exc
+        for addr in changed:
+            self._readWords(addr, addr+2)
+            if self.image[addr:addr+2] != newImage[addr:addr+2]:
+                raise pyftdi.eeprom.FtdiEepromError("Write to EEPROM failed @ 0x{0:02x}".format(addr))
+        return changed
+
+# just enough of pyftdi's Ftdi for FtdiEeprom to load and decode an image read with RawEeprom
+class RawEepromFtdi(object):
+    is_connected = True
+    is_eeprom_internal = False
+    max_eeprom_size = RawEeprom.SIZE
+
+    def __init__(self, rawEeprom, deviceVersion):
+        self.rawEeprom = rawEeprom
+        self.device_version = deviceVersion
+
+    def calc_eeprom_checksum(self, data):
+        return pyftdi.ftdi.Ftdi.calc_eeprom_checksum(self, data)
+
+    def read_eeprom(self, addr=0, length=None, eeprom_size=None):
+        self.rawEeprom.read()
+        if length is None:
+            length = RawEeprom.SIZE-addr
+        return self.rawEeprom.fullImage()[addr:addr+length]
+
+    def close(self):
+        pass
+
+# usb access through pyftdi to the modules actually connected
+class UsbBackend(object):
+    def listDevices(self):
+        pyftdi.usbtools.UsbTools.flush_cache()
+        return pyftdi.ftdi.Ftdi.list_devices("ftdi://ftdi:2232h/1")
+
+    def getDevice(self, deviceDesc):
+        return pyftdi.usbtools.UsbTools.get_device(deviceDesc[0])
+
+    def releaseDevice(self, device):
+        pyftdi.usbtools.UsbTools.release_device(device)
+
+    def close(self):
+        pass
+
+# binary usb session trace shared by the recorder and replayer
+# a header followed by records, each a type byte then a fixed struct and any variable length fields
+# every record holds the time the call took in microseconds
+class UsbTrace(object):
+    MAGIC = b'RYDEUSB1'
+    ENUMERATE = 1
+    OPEN = 2
+    TRANSFER = 3
+    RELEASE = 4
+    ENUMERATE_STRUCT = struct.Struct('<IH')
+    DESCRIPTOR_STRUCT = struct.Struct('<HHhhhh')
+    OPEN_STRUCT = struct.Struct('<HIH')
+    TRANSFER_STRUCT = struct.Struct('<HIBBHHHB')
+    RELEASE_STRUCT = struct.Struct('<H')
+    LENGTH_STRUCT = struct.Struct('<H')
+    NONE = 0xFFFF
+
+    @classmethod
+    def packBytes(cls, data):
+        if data is None:
+            return cls.LENGTH_STRUCT.pack(cls.NONE)
+        return cls.LENGTH_STRUCT.pack(len(data))+bytes(data)
+
+    @classmethod
+    def unpackBytes(cls, traceFile):
+        (length,) = cls.LENGTH_STRUCT.unpack(traceFile.read(cls.LENGTH_STRUCT.size))
+        if length == cls.NONE:
+            return None
+        return traceFile.read(length)
+
+    @classmethod
+    def packString(cls, string):
+        return cls.packBytes(None if string is None else string.encode('utf-8'))
+
+    @classmethod
+    def unpackString(cls, traceFile):
+        data = cls.unpackBytes(traceFile)
+        return None if data is None else data.decode('utf-8')
+
+    @staticmethod
+    def optionalInt(value):
+        return -1 if value is None else value
+
+# wraps a pyusb device recording each control transfer made through it
+class RecordedDevice(object):
+    def __init__(self, recorder, device, deviceId):
+        self.recorder = recorder
+        self.device = device
+        self.deviceId = deviceId
+        self.bcdDevice = device.bcdDevice
+
+    def ctrl_transfer(self, bmRequestType, bRequest, wValue=0, wIndex=0, data_or_wLength=None, timeout=None):
+        isIn = bool(bmRequestType & 0x80)
+        if isIn:
+            length = data_or_wLength if isinstance(data_or_wLength, int) else len(data_or_wLength)
+        else:
+            length = len(data_or_wLength or b'')
+        start = time.perf_counter_ns()
+        try:
+            result = self.device.ctrl_transfer(bmRequestType, bRequest, wValue, wIndex, data_or_wLength, timeout)
+        except usb.core.USBError as exc:
+            self.recorder.recordTransfer(self.deviceId, start, bmRequestType, bRequest, wValue, wIndex, length, None, str(exc))
+            raise
+        if not isIn:
+            data = bytes(data_or_wLength or b'')
+        elif isinstance(data_or_wLength, int):
+            data = bytes(result)
+        else:
+            data = bytes(data_or_wLength[:result])
+        self.recorder.recordTransfer(self.deviceId, start, bmRequestType, bRequest, wValue, wIndex, length, result if not isIn else len(data), data)
+        return result
+
+# usb backend that passes everything through to the real modules and records it to a trace file
+class UsbRecorder(UsbBackend):
+    def __init__(self, fileName):
+        self.traceFile = open(fileName, 'wb')
+        self.traceFile.write(UsbTrace.MAGIC)
+        self.nextDeviceId = 0
+
+    def _duration(self, start):
+        return min((time.perf_counter_ns()-start)//1000, 0xFFFFFFFF)
+
+    def listDevices(self):
+        start = time.perf_counter_ns()
+        foundDevices = super().listDevices()
+        record = [bytes([UsbTrace.ENUMERATE]), UsbTrace.ENUMERATE_STRUCT.pack(self._duration(start), len(foundDevices))]
+        for (desc, interface) in foundDevices:
+            record.append(UsbTrace.DESCRIPTOR_STRUCT.pack(desc.vid, desc.pid, UsbTrace.optionalInt(desc.bus), UsbTrace.optionalInt(desc.address), UsbTrace.optionalInt(desc.index), interface))
+            record.append(UsbTrace.packString(desc.sn))
+            record.append(UsbTrace.packString(desc.description))
+        self.traceFile.write(b''.join(record))
+        return foundDevices
+
+    def getDevice(self, deviceDesc):
+        start = time.perf_counter_ns()
+        device = RecordedDevice(self, super().getDevice(deviceDesc), self.nextDeviceId)
+        self.nextDeviceId = (self.nextDeviceId+1) & 0xFFFF
+        self.traceFile.write(bytes([UsbTrace.OPEN])+UsbTrace.OPEN_STRUCT.pack(device.deviceId, self._duration(start), device.bcdDevice))
+        return device
+
+    def releaseDevice(self, device):
+        super().releaseDevice(device.device)
+        self.traceFile.write(bytes([UsbTrace.RELEASE])+UsbTrace.RELEASE_STRUCT.pack(device.deviceId))
+
+    # result is the value returned for out transfers or the byte count for in transfers, None if the transfer raised
+    def recordTransfer(self, deviceId, start, bmRequestType, bRequest, wValue, wIndex, length, result, data):
+        failed = result is None
+        record = bytes([UsbTrace.TRANSFER])+UsbTrace.TRANSFER_STRUCT.pack(deviceId, self._duration(start), bmRequestType, bRequest, wValue, wIndex, length, failed)
+        if failed:
+            record += UsbTrace.packString(data)
+        else:
+            record += UsbTrace.LENGTH_STRUCT.pack(result)
+            if bmRequestType & 0x80:
+                record += UsbTrace.packBytes(data)
+        self.traceFile.write(record)
+
+    def close(self):
+        self.traceFile.close()
+        super().close()
+
+# stands in for a pyusb device, answering control transfers from a trace
+class ReplayDevice(object):
+    def __init__(self, replay, deviceId, bcdDevice):
+        self.replay = replay
+        self.deviceId = deviceId
+        self.bcdDevice = bcdDevice
+
+    def ctrl_transfer(self, bmRequestType, bRequest, wValue=0, wIndex=0, data_or_wLength=None, timeout=None):
+        (deviceId, duration, recType, recRequest, recValue, recIndex, length, failed), extra = self.replay.nextRecord(UsbTrace.TRANSFER)
+        if (deviceId, recType, recRequest, recValue, recIndex) != (self.deviceId, bmRequestType, bRequest, wValue, wIndex):
+            raise pyftdi.ftdi.FtdiError("USB replay diverged from trace at control transfer {0:02x}:{1:02x} {2:04x}:{3:04x}".format(bmRequestType, bRequest, wValue, wIndex))
+        self.replay.wait(duration)
+        if failed:
+            raise usb.core.USBError(extra)
+        result, data = extra
+        if not bmRequestType & 0x80:
+            return result
+        if isinstance(data_or_wLength, int):
+            return array.array('B', data)
+        data_or_wLength[:len(data)] = array.array('B', data)
+        return len(data)
+
+# usb backend that replays a recorded trace without any hardware, at the original speed scaled by speed or with no delays if speed is 0
+class UsbReplay(object):
+    def __init__(self, fileName, speed=1.0):
+        self.speed = speed
+        with open(fileName, 'rb') as traceFile:
+            if traceFile.read(len(UsbTrace.MAGIC)) != UsbTrace.MAGIC:
+                raise ValueError("Not a USB trace file: "+fileName)
+            self.records = self._readRecords(traceFile)
+        self.position = 0
+
+    @staticmethod
+    def _readRecords(traceFile):
+        records = []
+        while True:
+            recordType = traceFile.read(1)
+            if not recordType:
+                return records
+            recordType = recordType[0]
+            if recordType == UsbTrace.ENUMERATE:
+                fields = UsbTrace.ENUMERATE_STRUCT.unpack(traceFile.read(UsbTrace.ENUMERATE_STRUCT.size))
+                foundDevices = []
+                for deviceNum in range(fields[1]):
+                    vid, pid, bus, address, index, interface = UsbTrace.DESCRIPTOR_STRUCT.unpack(traceFile.read(UsbTrace.DESCRIPTOR_STRUCT.size))
+                    sn = UsbTrace.unpackString(traceFile)
+                    description = UsbTrace.unpackString(traceFile)
+                    desc = pyftdi.usbtools.UsbDeviceDescriptor(vid, pid, None if bus < 0 else bus, None if address < 0 else address, sn, None if index < 0 else index, description)
+                    foundDevices.append((desc, interface))
+                records.append((recordType, fields, foundDevices))
+            elif recordType == UsbTrace.OPEN:
+                records.append((recordType, UsbTrace.OPEN_STRUCT.unpack(traceFile.read(UsbTrace.OPEN_STRUCT.size)), None))
+            elif recordType == UsbTrace.TRANSFER:
+                fields = UsbTrace.TRANSFER_STRUCT.unpack(traceFile.read(UsbTrace.TRANSFER_STRUCT.size))
+                if fields[-1]:
+                    extra = UsbTrace.unpackString(traceFile)
+                else:
+                    (result,) = UsbTrace.LENGTH_STRUCT.unpack(traceFile.read(UsbTrace.LENGTH_STRUCT.size))
+                    data = UsbTrace.unpackBytes(traceFile) if fields[2] & 0x80 else None
+                    extra = (result, data)
+                records.append((recordType, fields, extra))
+            elif recordType == UsbTrace.RELEASE:
+                records.append((recordType, UsbTrace.RELEASE_STRUCT.unpack(traceFile.read(UsbTrace.RELEASE_STRUCT.size)), None))
+            else:
+                raise ValueError("Unknown USB trace record type {0}".format(recordType))
+
+    def nextRecord(self, recordType):
+        if self.position >= len(self.records):
+            raise pyftdi.ftdi.FtdiError("USB replay trace exhausted")
+        (foundType, fields, extra) = self.records[self.position]
+        if foundType != recordType:
+            raise pyftdi.ftdi.FtdiError("USB replay diverged from trace, expected record type {0} found {1}".format(recordType, foundType))
+        self.position += 1
+        return fields, extra
+
+    def wait(self, duration):
+        if self.speed > 0:
+            time.sleep(duration/1000000/self.speed)
+
+    def listDevices(self):
+        (duration, count), foundDevices = self.nextRecord(UsbTrace.ENUMERATE)
+        self.wait(duration)
+        return foundDevices
+
+    def getDevice(self, deviceDesc):
+        (deviceId, duration, bcdDevice), extra = self.nextRecord(UsbTrace.OPEN)
+        self.wait(duration)
+        return ReplayDevice(self, deviceId, bcdDevice)
+
+    def releaseDevice(self, device):
+        ((deviceId,), extra) = self.nextRecord(UsbTrace.RELEASE)
+        if deviceId != device.deviceId:
+            raise pyftdi.ftdi.FtdiError("USB replay diverged from trace releasing device")
+
+    def close(self):
+        pass
+
 # medium level interface to pyftdi
 class ModulesInterface(object):
-    def __init__(self, dryRun=True):
+    def __init__(self, dryRun=True, legacyEeprom=False, usbBackend=None):
         self.dryRun = dryRun
+        self.legacyEeprom = legacyEeprom
+        if usbBackend is None:
+            usbBackend = UsbBackend()
+        self.usbBackend = usbBackend
     
     # returns dict of mapping between all found device identifiers and sets of tuples of config name/values pairs
+    @tracer.traced("fetchDevices")
     def fetchDevices(self):
-        pyftdi.usbtools.UsbTools.flush_cache()
-        foundDevices = pyftdi.ftdi.Ftdi.list_devices("ftdi://ftdi:2232h/1")
+        with tracer.span("list_devices"):
+            foundDevices = self.usbBackend.listDevices()
         devices = {}
+        transfers = 0
         for deviceDesc in foundDevices:
-            device = pyftdi.usbtools.UsbTools.get_device(deviceDesc[0])
-            eeprom = pyftdi.eeprom.FtdiEeprom()
-            eeprom.open(device)
-            signature = []
-            for prop in sorted(list(eeprom.properties)+['product']):
-                signature.append((prop,getattr(eeprom, prop)))
-            devices[deviceDesc]=frozenset(signature)
-            eeprom.close()
-            pyftdi.usbtools.UsbTools.release_device(device)
+            device = self.usbBackend.getDevice(deviceDesc)
+            with UsbTransferCounter(device) as counter:
+                if self.legacyEeprom:
+                    eeprom = pyftdi.eeprom.FtdiEeprom()
+                    with tracer.span("eeprom.open", sn=deviceDesc[0].sn):
+                        eeprom.open(device)
+                    with tracer.span("signature"):
+                        signature = []
+                        for prop in sorted(list(eeprom.properties)+['product']):
+                            signature.append((prop,getattr(eeprom, prop)))
+                    devices[deviceDesc]=frozenset(signature)
+                    eeprom.close()
+                else:
+                    rawEeprom = RawEeprom(device)
+                    with tracer.span("eeprom.read", sn=deviceDesc[0].sn):
+                        rawEeprom.read()
+                    with tracer.span("signature"):
+                        devices[deviceDesc] = rawEeprom.signature(device.bcdDevice)
+            transfers += counter.count
+            self.usbBackend.releaseDevice(device)
+        tracer.addCounter("usbTransfers", scan=transfers)
         return devices
 
     # programs a device with a config out of the config enum
+    @tracer.traced("programModule")
     def programModule(self, deviceDesc, config):
-        device = pyftdi.usbtools.UsbTools.get_device(deviceDesc[0])
-        eeprom = pyftdi.eeprom.FtdiEeprom()
-        eeprom.open(device)
-        # hack #1 load closeish eeprom image as not all properties are configrarable
-        configIO = config.rawBaseline.baselineIni
-        eeprom.load_config(configIO, 'raw')
-        eeprom.sync()
-        varStringMap ={
-                'manufacturer': eeprom.set_manufacturer_name,
-                'product': eeprom.set_product_name,
-                'serial': eeprom.set_serial_number
-                }
-        toRetry = {}
-        for (prop, value) in config.configSet:
-            if getattr(eeprom, prop) != value:
-                if prop in varStringMap:
-                    varStringMap[prop](value)
+        device = self.usbBackend.getDevice(deviceDesc)
+        with UsbTransferCounter(device) as counter:
+            eeprom = pyftdi.eeprom.FtdiEeprom()
+            if self.legacyEeprom:
+                with tracer.span("eeprom.open", sn=deviceDesc[0].sn):
+                    eeprom.open(device)
+            else:
+                rawEeprom = RawEeprom(device)
+                with tracer.span("eeprom.read", sn=deviceDesc[0].sn):
+                    eeprom.connect(RawEepromFtdi(rawEeprom, device.bcdDevice))
+            oldImage = eeprom.data
+            # hack #1 load closeish eeprom image as not all properties are configrarable
+            configIO = config.rawBaseline.baselineIni
+            eeprom.load_config(configIO, 'raw')
+            with tracer.span("sync"):
+                eeprom.sync()
+            varStringMap ={
+                    'manufacturer': eeprom.set_manufacturer_name,
+                    'product': eeprom.set_product_name,
+                    'serial': eeprom.set_serial_number
+                    }
+            toRetry = {}
+            modified = False
+            for (prop, value) in config.configSet:
+                if getattr(eeprom, prop) != value:
+                    if prop in varStringMap:
+                        varStringMap[prop](value)
+                        modified = True
+                    else:
+                        try:
+                            eeprom.set_property(prop, value)
+                            modified = True
+                        except NotImplementedError:
+                            toRetry[prop]= value
+            # hack #2 the data doesn't get reparsed when loaded as a raw, retry failed properties at the end as something is likely to have caused it to get repared in the meantime
+            with tracer.span("sync"):
+                eeprom.sync()
+            for prop, value in toRetry.items():
+                if getattr(eeprom, prop) != value:
+                    eeprom.set_property(prop, value)
+                    modified = True
+            with tracer.span("commit", dryRun=self.dryRun):
+                if self.legacyEeprom:
+                    result = eeprom.commit(self.dryRun)
                 else:
-                    try:
-                        eeprom.set_property(prop, value)
-                    except NotImplementedError:
-                        toRetry[prop]= value
-        # hack #2 the data doesn't get reparsed when loaded as a raw, retry failed properties at the end as something is likely to have caused it to get repared in the meantime
-        eeprom.sync()
-        for prop, value in toRetry.items():
-            if getattr(eeprom, prop) != value:
-                eeprom.set_property(prop, value)
-        result = eeprom.commit(self.dryRun)
-        eeprom.close()
+                    # same result as commit, nothing is written if no property needed changing
+                    result = False
+                    if modified:
+                        rawEeprom.write(oldImage, eeprom.data, self.dryRun)
+                        result = self.dryRun
+            eeprom.close()
+        if not self.legacyEeprom:
+            self.usbBackend.releaseDevice(device)
+        tracer.addCounter("usbTransfers", program=counter.count)
         return result
 
 # UI widget that displays a list of found modules and manages their selection
@@ -463,7 +912,7 @@ class CommandListWidget(urwid.WidgetWrap):
 
 
 class TunerFTDIConfigUtil(object):
-    def __init__(self, dryRun=True, allowAllConfigs=False, attemptIdentUnknown=False):
+    def __init__(self, dryRun=True, allowAllConfigs=False, attemptIdentUnknown=False, legacyEeprom=False, usbBackend=None):
         colsBox = urwid.Columns([], 1)
         titlebox = urwid.AttrMap(urwid.Text('Tuner FTDI module configuration utility', align='center'), 'title')
         footerbox = urwid.AttrMap(urwid.Text(["To navigate use the keyboard or the mouse on compatible consoles"]), 'footer')
@@ -488,8 +937,9 @@ class TunerFTDIConfigUtil(object):
         ]
 
         self.loop = urwid.MainLoop(top, palette=pallette)
+        self.loop.draw_screen = tracer.traced("draw_screen")(self.loop.draw_screen)
 
-        ftdiInterface = ModulesInterface(dryRun)
+        ftdiInterface = ModulesInterface(dryRun, legacyEeprom, usbBackend)
         moduleList = ModuleListWidget(ftdiInterface, attemptIdentUnknown)
 
         commandList = CommandListWidget(ftdiInterface, moduleList, self.loop, allowAllConfigs, dryRun)
@@ -505,6 +955,26 @@ if __name__ == "__main__":
     parser.add_argument("-u", "--update", action="store_true", help="Enable actual updates")
     parser.add_argument("-x", "--extra-configs", action="store_true", help="Allow flashing of all identifyable configs")
     parser.add_argument("-i", "--attempt-ident-unknown", action="store_true", help="Attempt to partially identify unknown modules")
+    parser.add_argument("-l", "--legacy-eeprom", action="store_true", help="Use pyftdi's full EEPROM open and commit for every module")
+    parser.add_argument("-p", "--profile", nargs="?", const="ftdiconf-profile", default=None, metavar="PREFIX", help="Record a profile and trace to PREFIX.prof and PREFIX.json")
+    parser.add_argument("-r", "--record", metavar="FILE", help="Record all USB device access to a trace file")
+    parser.add_argument("-R", "--replay", metavar="FILE", help="Replay USB device access from a trace file instead of using real modules")
+    parser.add_argument("-s", "--replay-speed", type=float, default=1.0, metavar="SPEED", help="Replay speed multiplier, 0 replays without delays")
     args = parser.parse_args()
-    ftdiUI = TunerFTDIConfigUtil(not args.update, args.extra_configs, args.attempt_ident_unknown)
-    ftdiUI.run()
+    if args.record is not None and args.replay is not None:
+        parser.error("--record and --replay cannot be used together")
+    if args.legacy_eeprom and (args.record is not None or args.replay is not None):
+        parser.error("--legacy-eeprom cannot be recorded or replayed")
+    if args.replay is not None:
+        usbBackend = UsbReplay(args.replay, args.replay_speed)
+    elif args.record is not None:
+        usbBackend = UsbRecorder(args.record)
+    else:
+        usbBackend = UsbBackend()
+    def main():
+        try:
+            ftdiUI = TunerFTDIConfigUtil(not args.update, args.extra_configs, args.attempt_ident_unknown, args.legacy_eeprom, usbBackend)
+            ftdiUI.run()
+        finally:
+            usbBackend.close()
+    runProfiled(args.profile, main)
@@ -0,0 +1,126 @@
+#    Ryde Utils provides a set of useful utilities for the Ryde Receiver project.
+#    Copyright © 2021 Tim Clark
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time, json, os, threading, functools, contextlib, cProfile
+
+# context manager that does nothing, shared by all spans while tracing is off
+_nullSpan = contextlib.nullcontext()
+
+# context manager that records a single timed span into a tracer
+class TraceSpan(object):
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        end = time.perf_counter_ns()
+        self.tracer.addSpan(self.name, self.start, end, self.args)
+        return False
+
+# lightweight span tracer with optional cProfile capture, writes chrome trace json and a cProfile dump
+class Tracer(object):
+    def __init__(self):
+        self.enabled = False
+        self.profiler = None
+        self.events = []
+        self.pid = os.getpid()
+        self.origin = time.perf_counter_ns()
+
+    # start recording spans and profiling
+    def start(self, profile=True):
+        self.events = []
+        self.origin = time.perf_counter_ns()
+        self.enabled = True
+        if profile:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    # stop recording spans and profiling
+    def stop(self):
+        self.enabled = False
+        if self.profiler is not None:
+            self.profiler.disable()
+
+    # returns a context manager timing the enclosed block, a shared no-op when disabled
+    def span(self, name, **args):
+        if not self.enabled:
+            return _nullSpan
+        return TraceSpan(self, name, args)
+
+    # decorator version of span for whole functions
+    def traced(self, name):
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with TraceSpan(self, name, {}):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    # record a complete span, times are perf_counter_ns values
+    def addSpan(self, name, start, end, args=None):
+        event = {
+            'name': name,
+            'ph': 'X',
+            'ts': (start-self.origin)/1000,
+            'dur': (end-start)/1000,
+            'pid': self.pid,
+            'tid': threading.get_ident(),
+            }
+        if args:
+            event['args'] = args
+        self.events.append(event)
+
+    # record a named counter value, shown as a graph in the trace viewer
+    def addCounter(self, name, **values):
+        if not self.enabled:
+            return
+        self.events.append({
+            'name': name,
+            'ph': 'C',
+            'ts': (time.perf_counter_ns()-self.origin)/1000,
+            'pid': self.pid,
+            'args': values,
+            })
+
+    # write <prefix>.json in chrome trace format and <prefix>.prof as a cProfile dump
+    def writeResults(self, prefix):
+        with open(prefix+".json", 'w') as traceFile:
+            json.dump({'traceEvents': list(self.events), 'displayTimeUnit': 'ms'}, traceFile)
+        if self.profiler is not None:
+            self.profiler.dump_stats(prefix+".prof")
+
+# shared tracer used by all the utilities
+tracer = Tracer()
+
+# run a main function with tracing enabled if a profile prefix is given, results are always written on exit
+def runProfiled(prefix, mainFunc):
+    if prefix is None:
+        return mainFunc()
+    tracer.start()
+    try:
+        return mainFunc()
+    finally:
+        tracer.stop()
+        tracer.writeResults(prefix)